@@ -1,42 +1,89 @@
 import argparse
+import concurrent.futures
+import functools
+import hashlib
 import json
 import logging
 import os.path
 import re
+import socket
 import subprocess
 import sys
-
-import pybitbucket.auth
-from pybitbucket import bitbucket
-# Those imports have side-effects, thus needed. pylint: disable=unused-import
-from pybitbucket import comment as _comment
-from pybitbucket import pullrequest as _pullrequest
-from pybitbucket import repository as _repository
-from pybitbucket import user as _user
-# pylint: enable=unused-import
-import uritemplate
-
-
-# The built-in methods of the bitbucket SDK do not support queries and sort on pullrequest.
-# Adding it here manually.
-PR_BY_QUERY_ENDPOINT = {
-    "_links": {
-        "repositoryPullRequestsByQuery": {
-            "href": ("https://api.bitbucket.org/2.0/repositories{/owner,repository_name}"
-                     "/pullrequests{?q,sort}"),
-        },
-    },
-}
-POST_COMMENT_TEMPLATE = ("{+bitbucket_url}/2.0/repositories{/owner,repository_name}"
-                         "/pullrequests{/pullrequest_id}/comments")
-DIFF_SCOPE_RE = re.compile(r"^@@ -\d+,\d+ \+(\d+),(\d+) @@")
+import types
+
+# orjson parses JSON much faster than the stdlib, but is optional.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import requests
+import requests.adapters
+import requests.models
+
+if orjson is not None:
+    # Route Response.json() through orjson as well, so the paginated API
+    # responses (PR search, comments, diffstat) get the same speedup as the
+    # pylint report. orjson rejects NaN just like allow_nan=False would.
+    requests.models.complexjson = types.SimpleNamespace(
+        loads=orjson.loads,
+        dumps=lambda obj, **_kwargs: orjson.dumps(obj).decode())
+
+
+API_BASE_URL = "https://api.bitbucket.org/2.0"
+DIFF_SCOPE_RE = re.compile(rb"^@@ -\d+,\d+ \+(\d+),(\d+) @@")
+# How many comments to post to bitbucket in parallel.
+MAX_POST_WORKERS = 16
+# When set, points at the UNIX socket of a long-running linter daemon.
+SOCKET_ENV_VAR = "BITBUCKET_LINTER_SOCKET"
+
+
+def _make_session():
+    """Returns a requests session with pooling and retries configured."""
+    session = requests.Session()
+    # Pool enough connections for the comment-posting thread pool, and
+    # retry transient API failures with exponential backoff instead of
+    # failing the whole run on a single 5xx/429 brownout.
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=MAX_POST_WORKERS, pool_maxsize=2 * MAX_POST_WORKERS,
+        max_retries=requests.adapters.Retry(
+            total=5, backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504)))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def comment_digest(path, line, content):
+    """Returns a compact fixed-size key identifying an inline comment.
+
+    Comment bodies can be kilobytes long; hashing them keeps the dedup set
+    small and makes membership tests cheap.
+    """
+    key = "\0".join((path, str(line), content))
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
 
 
 class PullRequest:
-    def __init__(self, pr, user):
-        self.id = pr.id
+    def __init__(self, session, pr, user):
+        self.id = pr["id"]
+        self._session = session
         self._pr = pr
         self._user = user
+        # The comments URI is the same for every comment; build it once.
+        full_name = pr["source"]["repository"]["full_name"]
+        self._comments_uri = (
+            f"{API_BASE_URL}/repositories/{full_name}/pullrequests/{self.id}/comments")
+
+    def _paginate(self, uri, params=None):
+        """Yields the values of a paginated API endpoint, page by page."""
+        while uri:
+            resp = self._session.get(uri, params=params)
+            resp.raise_for_status()
+            page = resp.json()
+            yield from page.get("values", [])
+            # The "next" link already carries the query parameters.
+            uri, params = page.get("next"), None
 
     def get_changed_lines(self, file_ext, exclude_paths):
         """Retruns a mapping between changed files and a set of changed line numbers."""
@@ -44,37 +91,66 @@ class PullRequest:
         res = {}
         # Filtering out deleted files, and files not ending with file_ext.
         # TODO: Consider skipping files that are only moved (without changes).
-        for diffstat in self._pr.diffstat():
+        # Only ask for the two fields we read, in as few pages as possible.
+        params = {
+            "fields": "values.status,values.new.path,next",
+            "pagelen": 100,
+        }
+        for diffstat in self._paginate(self._pr["links"]["diffstat"]["href"], params):
             if (diffstat["status"] != "removed" and
                 diffstat["new"]["path"].endswith(file_ext) and
                 (not exclude_paths or not diffstat["new"]["path"].startswith(tuple(exclude_paths)))):
                 res[diffstat["new"]["path"]] = set()
 
+        if not res:
+            # No file matched; don't bother downloading the diff at all.
+            return res
+
         fname = None
-        for line in self._pr.diff().decode().split("\n"):
-            if line.startswith("+++ b/"):
-                fname = line[6:]
-            if line.startswith("@@ -") and fname in res:
+        # Stream the diff rather than buffering it; it can be many MB for a
+        # big PR and we only ever look at one line at a time.
+        resp = self._session.get(self._pr["links"]["diff"]["href"], stream=True)
+        resp.raise_for_status()
+        # Work on raw bytes; only the occasional file name gets decoded.
+        for line in resp.iter_lines():
+            if line.startswith(b"+++ b/"):
+                fname = line[6:].decode()
+            elif line.startswith(b"@@ -") and fname in res:
                 match = DIFF_SCOPE_RE.match(line)
                 start = int(match.group(1))
                 length = int(match.group(2))
                 res[fname].update(range(start, start+length))
-        return res
-
-    def get_comments(self):
-        return set((c.inline["path"], c.inline["to"], c.content["raw"])
-                   for c in self._pr.comments() if not isinstance(c, dict) and
-                   not c.deleted and c.user["uuid"] == self._user.uuid and
-                   "inline" in c.attributes())
+        # The scopes are only read from here on; freeze them.
+        return {path: frozenset(lines) for path, lines in res.items()}
+
+    @functools.cached_property
+    def comments(self):
+        """The digests of the inline comments this user already posted.
+
+        Cached, so repeated reads don't refetch the paginated comment list.
+        """
+        # Filtering server-side keeps us from paging through the human
+        # discussion; the checks below are kept as a fallback in case the
+        # server ignores the query.
+        my_uuid = self._user["uuid"]
+        params = {
+            "q": 'user.uuid = "%s" AND deleted = false' % my_uuid,
+            "fields": ("values.inline.path,values.inline.to,values.content.raw,"
+                       "values.user.uuid,values.deleted,next"),
+            "pagelen": 100,
+        }
+        digests = set()
+        for c in self._paginate(self._comments_uri, params):
+            inline = c.get("inline")
+            if inline is None or c.get("deleted"):
+                continue
+            if c["user"]["uuid"] != my_uuid:
+                continue
+            digests.add(comment_digest(inline["path"], inline["to"],
+                                       c["content"]["raw"]))
+        return digests
 
     def post_comment(self, path, line, content):
-        owner, repository_name = self._pr.source_repository.full_name.split("/")
-        api_uri = uritemplate.expand(POST_COMMENT_TEMPLATE, {
-            "bitbucket_url": self._pr.client.get_bitbucket_url(),
-            "owner": owner,
-            "repository_name": repository_name,
-            "pullrequest_id": str(self._pr.id),
-        })
         data = {
             "content": {
                 "raw": content,
@@ -84,42 +160,78 @@ class PullRequest:
                 "to": line,
             },
         }
-        resp = self._pr.client.session.post(api_uri, json=data)
+        resp = self._session.post(self._comments_uri, json=data)
         if not resp.ok:
             logging.error("Failed posting comment on %s:%s: %s", path, line, resp.text)
 
     def approve(self):
-        self._pr.approve()
+        resp = self._session.post(self._pr["links"]["approve"]["href"])
+        # 409 means we already approved this PR; nothing to do.
+        if not resp.ok and resp.status_code != 409:
+            logging.error("Failed approving PR: %s", resp.text)
 
     def unapprove(self):
-        self._pr.unapprove()
+        resp = self._session.delete(self._pr["links"]["approve"]["href"])
+        # 404 means we never approved this PR; nothing to do.
+        if not resp.ok and resp.status_code != 404:
+            logging.error("Failed unapproving PR: %s", resp.text)
 
     @staticmethod
-    def get_pull_request(username, password, email, repository_name, owner, branch_name):
+    def get_pull_request(username, password, email, repository_name, owner, branch_name,
+                         session=None):
         """Returns the latest updated OPEN pull request for a particular branch."""
-        client = bitbucket.Client(pybitbucket.auth.BasicAuthenticator(username, password, email))
-        bb = bitbucket.Bitbucket(client)
-        bb.add_remote_relationship_methods(PR_BY_QUERY_ENDPOINT)
-
-        res = bb.repositoryPullRequestsByQuery(
-            owner=owner,
-            repository_name=repository_name,
-            q='source.branch.name = "%s" AND state = "OPEN"' % branch_name, sort="-updated_on")
-
-        pr = next(res)
-        # This is weird, but if there's no data, we're getting a dict back.
-        if isinstance(pr, dict):
+        del email  # Only basic auth is used since dropping pybitbucket.
+        if session is None:
+            session = _make_session()
+        session.auth = (username, password)
+
+        # The PR search and the user lookup are independent; issue them in
+        # parallel to halve the startup latency.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            pr_future = executor.submit(
+                session.get,
+                f"{API_BASE_URL}/repositories/{owner}/{repository_name}/pullrequests",
+                params={
+                    "q": 'source.branch.name = "%s" AND state = "OPEN"' % branch_name,
+                    "sort": "-updated_on",
+                })
+            user_future = executor.submit(session.get, f"{API_BASE_URL}/user")
+
+        resp = pr_future.result()
+        resp.raise_for_status()
+        prs = resp.json().get("values", [])
+        if not prs:
             return None
-        user = next(bb.userForMyself())
-        return PullRequest(pr, user)
+
+        resp = user_future.result()
+        resp.raise_for_status()
+        return PullRequest(session, prs[0], resp.json())
+
+
+@functools.lru_cache(maxsize=None)
+def _canonical_path(path):
+    """Canonicalizes a path to match bitbucket's relative paths.
+
+    Cached, since pylint repeats the same path for every message in a file
+    and os.path.relpath is not cheap.
+    """
+    return os.path.relpath(path) if path.startswith("/") else path
 
 
 def run_pylint(linter, linter_flags, files_to_lint):
-    print([linter, "--output-format=json"] + linter_flags + list(files_to_lint))
+    files_to_lint = list(files_to_lint)
+    if not files_to_lint:
+        # No point paying the linter's startup cost (pylint even treats an
+        # empty file list as a usage error).
+        return []
+
+    # --jobs=0 lints files on all cores; --persistent=n skips the stats
+    # cache, which is useless (and slow) on throwaway CI filesystems.
+    # User-supplied linter_flags come later and can override both.
     pylint_proc = subprocess.run(
-        [linter, "--output-format=json"] + linter_flags + list(files_to_lint),
+        [linter, "--output-format=json", "--jobs=0", "--persistent=n"] +
+        linter_flags + files_to_lint,
         stdout=subprocess.PIPE,
-        universal_newlines=True,
     )
 
     if pylint_proc.returncode >= 32:
@@ -127,12 +239,12 @@ def run_pylint(linter, linter_flags, files_to_lint):
 
     pylint_output = []
     if pylint_proc.stdout:
-        pylint_output = json.loads(pylint_proc.stdout)
+        loads = orjson.loads if orjson is not None else json.loads
+        pylint_output = loads(pylint_proc.stdout)
 
     # Sometimes we need to canonicalize path to match bitbucket's output.
     for lint_entry in pylint_output:
-        if lint_entry["path"].startswith("/"):
-            lint_entry["path"] = os.path.relpath(lint_entry["path"])
+        lint_entry["path"] = _canonical_path(lint_entry["path"])
 
     return pylint_output
 
@@ -141,26 +253,46 @@ def lint_pr(pr, linter, linter_flags, approve, exclude_paths):
     logging.info("Running pylint for PR %s.", pr.id)
     changed_lines = pr.get_changed_lines(".py", exclude_paths)
     pylint_output = run_pylint(linter, linter_flags, changed_lines.keys())
-    comments = pr.get_comments()
 
     approved = True
+    seen = set()
+    to_post = []
+    # Pylint groups its messages by file, so rebind the scope only when the
+    # path changes instead of hashing the path for every message.
+    last_path, scope = None, frozenset()
     for lint_entry in pylint_output:
-        if lint_entry["line"] not in changed_lines[lint_entry["path"]]:
-            logging.info("Skipping comment on %s:%d, not in the PR scope.",
-                         lint_entry["path"], lint_entry["line"])
+        path, line = lint_entry["path"], lint_entry["line"]
+        if path != last_path:
+            last_path, scope = path, changed_lines.get(path, frozenset())
+        if line not in scope:
+            logging.info("Skipping comment on %s:%d, not in the PR scope.", path, line)
             continue
 
         approved = False
-        content = "%(type)s (%(message-id)s %(symbol)s):\n\n> %(message)s" % lint_entry
+        # Some checks (e.g. duplicate-code) report the same spot twice; skip
+        # repeats before doing any of the formatting work.
+        seen_key = (path, line, lint_entry["message-id"])
+        if seen_key in seen:
+            continue
+        seen.add(seen_key)
+
+        content = (f"{lint_entry['type']} ({lint_entry['message-id']} "
+                   f"{lint_entry['symbol']}):\n\n> {lint_entry['message']}")
 
-        comment_key = (lint_entry["path"], lint_entry["line"], content)
-        if comment_key in comments:
-            logging.info("Skipping comment on %s:%d, already in the PR.",
-                         lint_entry["path"], lint_entry["line"])
+        # pr.comments is fetched lazily, so clean runs that reach this point
+        # for no entry never pay for the comment listing at all.
+        if comment_digest(path, line, content) in pr.comments:
+            logging.info("Skipping comment on %s:%d, already in the PR.", path, line)
             continue
 
-        logging.info("Posting comment on %s:%d.", lint_entry["path"], lint_entry["line"])
-        pr.post_comment(*comment_key)
+        logging.info("Posting comment on %s:%d.", path, line)
+        to_post.append((path, line, content))
+
+    if to_post:
+        # Every post is a separate HTTPS round-trip; issue them in parallel.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(MAX_POST_WORKERS, len(to_post))) as executor:
+            list(executor.map(lambda args: pr.post_comment(*args), to_post))
 
     if not approve:
         logging.info("Not %s PR, --approve=false.", "approving" if approved else "unapproving")
@@ -175,7 +307,7 @@ def lint_pr(pr, linter, linter_flags, approve, exclude_paths):
     pr.unapprove()
 
 
-def main():
+def run(argv, session=None):
     parser = argparse.ArgumentParser(
         description="Runs pylint on changed py files of a Bitbucket PR, and leaves comments.")
     parser.add_argument("username")
@@ -188,12 +320,11 @@ def main():
     parser.add_argument("--linter", default="pylint")
     parser.add_argument("--approve", type=bool, default=False)
     parser.add_argument("--exclude-path", type=str, action="append")
-    args = parser.parse_args()
-
-    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args(argv)
 
     pr = PullRequest.get_pull_request(
-        args.username, args.password, args.email, args.repository, args.owner, args.branch)
+        args.username, args.password, args.email, args.repository, args.owner, args.branch,
+        session=session)
     if pr is None:
         logging.warning("No PR found for branch '%s'. Exiting", args.branch)
         return 1
@@ -201,5 +332,89 @@ def main():
     return 0
 
 
+def serve(socket_path):
+    """Serves lint runs submitted over a UNIX socket.
+
+    Keeps the process and its pooled HTTP session alive between runs, so the
+    per-invocation startup (interpreter, imports, TLS handshakes) is paid
+    once instead of per linted PR.
+    """
+    if os.path.exists(socket_path):
+        # A socket file left behind by a crashed daemon would make bind()
+        # fail; remove it, but only after checking nothing is listening on
+        # it - we must not steal a live daemon's socket.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with probe:
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                logging.error("Another daemon is already serving %s.", socket_path)
+                return 1
+
+    session = _make_session()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    # The socket file is ours only once bound; never unlink it before that.
+    try:
+        server.listen(1)
+        logging.info("Serving lint runs on %s.", socket_path)
+        while True:
+            conn, _ = server.accept()
+            with conn, conn.makefile("rb") as reader:
+                data = reader.read()
+                if not data:
+                    # Liveness probes (see above) send nothing; ignore them.
+                    continue
+                request = json.loads(data)
+                try:
+                    # The whole pipeline is CWD-relative (the linter runs on
+                    # repo-relative paths, and _canonical_path resolves
+                    # against the CWD), so run where the client ran.
+                    os.chdir(request["cwd"])
+                    _canonical_path.cache_clear()
+                    status = run(request["argv"], session)
+                except SystemExit as e:  # Bad argv; argparse tried to exit.
+                    status = e.code if isinstance(e.code, int) else 1
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Lint run failed.")
+                    status = 1
+                conn.sendall(b"%d" % status)
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def submit(socket_path, argv):
+    """Forwards a lint run to the daemon; returns its exit status."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        client.connect(socket_path)
+        client.sendall(json.dumps({"cwd": os.getcwd(), "argv": argv}).encode())
+        client.shutdown(socket.SHUT_WR)
+        return int(client.recv(16) or b"1")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    argv = sys.argv[1:]
+    socket_path = os.environ.get(SOCKET_ENV_VAR)
+    if argv == ["--daemon"]:
+        if not socket_path:
+            logging.error("--daemon requires %s to point at a socket path.", SOCKET_ENV_VAR)
+            return 1
+        return serve(socket_path)
+
+    if socket_path and os.path.exists(socket_path):
+        try:
+            return submit(socket_path, argv)
+        except OSError:
+            logging.warning("Could not reach the daemon on %s; running directly.", socket_path)
+    return run(argv)
+
+
 if __name__ == "__main__":
     sys.exit(main())
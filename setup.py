@@ -56,12 +56,14 @@ setup(
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.8',
     ],
 
+    # f-strings and functools.cached_property require at least 3.8.
+    python_requires='>=3.8',
+
     # What does your project relate to?
-    keywords='bitbucket,lint,pylint,pybitbucket',
+    keywords='bitbucket,lint,pylint',
 
     # You can just specify the packages manually here if your project is
     # simple. Or you can use find_packages().
@@ -76,8 +78,7 @@ setup(
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=[
-        "pybitbucket>=0.12.0",
-        "uritemplate>=0.6",
+        "requests>=2.4",
     ],
 
     # List additional groups of dependencies here (e.g. development